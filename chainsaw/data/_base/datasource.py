@@ -29,6 +29,7 @@ from chainsaw import config
 
 from six import string_types
 import os
+from stat import S_ISREG
 
 
 class DataSource(Iterable, TrajectoryRandomAccessible):
@@ -100,8 +101,9 @@ class DataSource(Iterable, TrajectoryRandomAccessible):
                     self.logger.exception('Error during access of file "%s"' % f)
                     raise ValueError('could not read file "%s"' % f)
 
-                if not os.path.isfile(f):  # can be true for symlinks to directories
-                    raise ValueError('"%s" is not a valid file')
+                # reuse the stat result instead of calling os.path.isfile (symlinks are already resolved).
+                if not S_ISREG(stat.st_mode):  # can be true for symlinks to directories
+                    raise ValueError('"%s" is not a valid file' % f)
 
                 if stat.st_size == 0:
                     raise ValueError('file "%s" is empty' % f)
@@ -119,18 +121,26 @@ class DataSource(Iterable, TrajectoryRandomAccessible):
             ndims = []
             # avoid cyclic imports
             from ..util.traj_info_cache import TrajectoryInfoCache
-            if len(filename_list) > 3:
+            show_progress = len(filename_list) > 3
+            if show_progress:
                 self._progress_register(len(filename_list), 'Obtaining file info')
-            for filename in filename_list:
-                if config.use_trajectory_lengths_cache:
-                    info = TrajectoryInfoCache.instance()[filename, self]
-                else:
-                    info = self._get_traj_info(filename)
+
+            def update_progress():
+                if show_progress:
+                    self._progress_update(1)
+
+            if config.use_trajectory_lengths_cache:
+                infos = TrajectoryInfoCache.instance().bulk_lookup(filename_list, self,
+                                                                   callback=update_progress)
+            else:
+                infos = []
+                for filename in filename_list:
+                    infos.append(self._get_traj_info(filename))
+                    update_progress()
+            for info in infos:
                 lengths.append(info.length)
                 offsets.append(info.offsets)
                 ndims.append(info.ndim)
-                if len(filename_list) > 3:
-                    self._progress_update(1)
 
             # ensure all trajs have same dim
             if not np.unique(ndims).size == 1:
@@ -230,8 +240,8 @@ class DataSource(Iterable, TrajectoryRandomAccessible):
                                 for itraj in range(n)),
                                dtype=int, count=n)
         else:
-            return np.fromiter(((l - skip - 1) // stride + 1 for l in self._lengths),
-                               dtype=int, count=n)
+            lengths = np.asarray(self._lengths, dtype=int)
+            return (lengths - skip - 1) // stride + 1
 
     def n_frames_total(self, stride=1, skip=0):
         r"""Returns total number of frames.
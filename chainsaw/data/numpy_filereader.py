@@ -96,9 +96,23 @@ class NumPyFileReader(DataSource):
         return arr
 
     def _get_traj_info(self, filename):
-        idx = self.filenames.index(filename)
-        array = self._load_file(idx)
-        length, ndim = np.shape(array)
+        # only parse the header of the file to obtain the shape, the data is not touched.
+        with open(filename, 'rb') as fh:
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(fh)
+            elif version == (2, 0):
+                shape, _, _ = np.lib.format.read_array_header_2_0(fh)
+            else:
+                shape = None
+
+        if shape is None:
+            idx = self.filenames.index(filename)
+            length, ndim = np.shape(self._load_file(idx))
+        else:
+            # same shape as obtained by _reshape
+            length = shape[0]
+            ndim = int(np.prod(shape[1:])) if len(shape) > 1 else 1
 
         return TrajInfo(ndim, length)
 
@@ -23,8 +23,9 @@ Created on 11.04.2015
 from __future__ import absolute_import
 
 import csv
+import mmap
 import os
-from math import ceil
+from contextlib import closing
 
 import numpy as np
 import six
@@ -225,6 +226,8 @@ class PyCSVReader(DataSource):
     For reading files with only one column, one needs to specify a delimter...
     """
     DEFAULT_OPEN_MODE = 'r'  # read in text-mode
+    # number of bytes compared at once while searching for line breaks
+    OFFSETS_SCAN_WINDOW = 64 * 1024**2
 
     def __init__(self, filenames, chunksize=1000, delimiters=None, comments='#',
                  converters=None, **kwargs):
@@ -356,26 +359,29 @@ class PyCSVReader(DataSource):
             byte offsets
         """
 
-        def new_size(x):
-            return int(ceil(x * 1.2))
-
         filename = fh.name
-        fh.seek(0)
-        # approx by filesize / (first line + 20%)
-        fh.readline()  # skip first line, because it may contain a much shorter header, which will give a bad estimate
-        size = new_size(os.stat(filename).st_size / len(fh.readline()))
-        offsets = np.empty(size, dtype=np.int64)
-        offsets[0] = 0
-        i = 1
-        # re-open in binary mode to circumvent a bug in Py3.5 win, where the first offset reported by tell
-        # overflows int64.
+        # re-open in binary mode and find all line breaks with a vectorized scan over the
+        # memory mapped file, instead of calling readline() and tell() for every line.
+        # The file is scanned in windows to bound the size of the temporary comparison array.
+        window = PyCSVReader.OFFSETS_SCAN_WINDOW
+        newlines = [np.empty(0, dtype=np.int64)]
         with open(filename, 'rb') as fh:
-            while fh.readline():
-                offsets[i] = fh.tell()
-                i += 1
-                if i >= len(offsets):
-                    offsets = np.resize(offsets, new_size(len(offsets)))
-        offsets = offsets[:i]
+            size = os.fstat(fh.fileno()).st_size
+            if size > 0:
+                with closing(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)) as buf:
+                    for start in range(0, size, window):
+                        data = np.frombuffer(buf, dtype=np.uint8, offset=start,
+                                             count=min(window, size - start))
+                        newlines.append(np.flatnonzero(data == ord(b'\n')) + start)
+                        # release the buffer export, otherwise the map can not be closed.
+                        del data
+        newlines = np.concatenate(newlines)
+        offsets = np.empty(len(newlines) + 1, dtype=np.int64)
+        offsets[0] = 0
+        offsets[1:] = newlines + 1
+        # last line without a trailing line break
+        if offsets[-1] != size:
+            offsets = np.append(offsets, size)
 
         # filter empty lines (offset between two lines is only 1 or 2 chars)
         # insert an diff of 2 at the beginning to match the amount of indices
@@ -43,6 +43,11 @@ class AbstractDB(object):
         # value: TrajInfo
         pass
 
+    def bulk_set(self, values):
+        # values: iterable of TrajInfo
+        for value in values:
+            self.set(value)
+
     def update(self, value):
         pass
 
@@ -76,8 +81,13 @@ class DictDB(AbstractDB):
     def update(self, value):
         self._db[value.hash_value] = value
 
+    def get(self, key):
+        return self._db[key]
+
     def clear(self):
+        version = self.db_version
         self._db.clear()
+        self.db_version = version
 
     @property
     def db_version(self):
@@ -93,6 +103,10 @@ class DictDB(AbstractDB):
 
 
 class SqliteDB(AbstractDB):
+    # an entry for an existing hash (eg. inserted concurrently by another process) is replaced.
+    _INSERT_STATEMENT = ("INSERT OR REPLACE INTO traj_info (hash, length, ndim, offsets, abs_path, version, lru_db)"
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)")
+
     def __init__(self, filename=None, clean_n_entries=30):
         """
         :param filename: path to database file
@@ -127,6 +141,7 @@ class SqliteDB(AbstractDB):
         self.filename = filename
 
         try:
+            self._set_pragmas()
             cursor = self._database.execute("select num from version")
             row = cursor.fetchone()
             if not row:
@@ -149,6 +164,18 @@ class SqliteDB(AbstractDB):
             shutil.move(filename, bak)
             SqliteDB.__init__(self, filename)
 
+    def _set_pragmas(self):
+        self._database.execute("PRAGMA temp_store=MEMORY")
+        # write ahead logging only needs to sync the log on commit, and readers do not block the writer.
+        # It relies on shared memory, so it does not work on network file systems and is opt-in.
+        if config.traj_info_use_wal:
+            self._database.execute("PRAGMA journal_mode=WAL")
+            self._database.execute("PRAGMA synchronous=NORMAL")
+            self._database.execute("PRAGMA mmap_size=%i" % (256 * 1024**2))
+        else:
+            # the journal mode is persistent, so switch back databases which used WAL before.
+            self._database.execute("PRAGMA journal_mode=DELETE")
+
     def _create_new_db(self):
         # assumes self.database is a sqlite3.Connection
         create_version_table = "CREATE TABLE version (num INTEGER PRIMARY KEY);"
@@ -189,35 +216,60 @@ class SqliteDB(AbstractDB):
         c = self._database.execute("SELECT COUNT(hash) from traj_info;").fetchone()
         return int(c[0])
 
-    def set(self, traj_info):
-        import sqlite3
-        values = (
+    def _values_for_sql(self, traj_info):
+        return (
             traj_info.hash_value, traj_info.length, traj_info.ndim,
             np.array(traj_info.offsets), traj_info.abs_path, TrajectoryInfoCache.DB_VERSION,
             # lru db
             self._database_from_key(traj_info.hash_value)
         )
-        statement = ("INSERT INTO traj_info (hash, length, ndim, offsets, abs_path, version, lru_db)"
-                     "VALUES (?, ?, ?, ?, ?, ?, ?)", values)
-        try:
-             self._database.execute(*statement)
-        except sqlite3.IntegrityError as ie:
-            logger.exception("insert failed: %s " % ie)
-            return
+
+    def set(self, traj_info):
+        values = self._values_for_sql(traj_info)
+        self._database.execute(self._INSERT_STATEMENT, values)
         self._database.commit()
 
         self._update_time_stamp(hash_value=traj_info.hash_value)
+        self._clean_if_needed()
+
+    def bulk_set(self, traj_infos):
+        """ inserts all given TrajInfo objects within a single transaction. """
+        values = [self._values_for_sql(info) for info in traj_infos]
+        if not values:
+            return
+        # time stamps first, so the new entries take part in the clean up.
+        self._update_time_stamps([v[0] for v in values])
+
+        # insertion and eviction of the oldest entries are committed at once.
+        self._database.execute("BEGIN")
+        try:
+            self._database.executemany(self._INSERT_STATEMENT, values)
+            self._clean_if_needed()
+        except Exception:
+            self._database.execute("ROLLBACK")
+            raise
+        self._database.execute("COMMIT")
 
+    @property
+    def _size(self):
+        # size of the database in bytes, also accounts for pages not yet check-pointed from the log.
+        page_count = self._database.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._database.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def _clean_if_needed(self):
         if self.filename is not None:
-            current_size = os.stat(self.filename).st_size
-            if (self.num_entries >= config.traj_info_max_entries or
+            current_size = self._size
+            # after bulk insertions more entries than n % may exceed the limit.
+            overflow = self.num_entries - config.traj_info_max_entries + 1
+            if (overflow > 0 or
                     # current_size is in bytes, while traj_info_max_size is in MB
                     1.*current_size / 1024**2 >= config.traj_info_max_size):
                 logger.info("Cleaning database because it has too much entries or is too large.\n"
                             "Entries: %s. Size: %.2fMB. Configured max_entires: %s. Max_size: %sMB"
                             % (self.num_entries, (current_size*1.0 / 1024**2),
                                config.traj_info_max_entries, config.traj_info_max_size))
-                self._clean(n=self.clean_n_entries)
+                self._clean(n=self.clean_n_entries, min_delete=overflow)
 
     def get(self, key):
         cursor = self._database.execute("SELECT * FROM traj_info WHERE hash=?", (key,))
@@ -249,31 +301,49 @@ class SqliteDB(AbstractDB):
         # bin hash to one of either 10 different databases
         # TODO: make a configuration parameter out of this number
         db_name = str(hash_value_long)[-1] + '.db'
-        directory = os.path.dirname(self.filename) + os.path.sep + 'traj_info_usage'
+        directory = self._usage_directory
         mkdir_p(directory)
         return os.path.join(directory, db_name)
 
+    @property
+    def _usage_directory(self):
+        return os.path.dirname(self.filename) + os.path.sep + 'traj_info_usage'
+
+    def _usage_databases(self):
+        """ all existing LRU databases, including those without any live traj_info entry. """
+        import glob
+        return glob.glob(os.path.join(self._usage_directory, '*.db'))
+
     def _update_time_stamp(self, hash_value):
         """ timestamps are being stored distributed over several lru databases.
         The timestamp is a time.time() snapshot (float), which are seconds since epoch."""
-        db_name = self._database_from_key(hash_value)
-        if not db_name:
-            db_name=':memory:'
+        self._update_time_stamps([hash_value])
 
+    def _update_time_stamps(self, hash_values):
+        """ updates the timestamps of all given hashes, using one transaction per lru database. """
         import sqlite3
 
-        with sqlite3.connect(db_name) as conn:
-            """ last_read is a result of time.time()"""
-            conn.execute('CREATE TABLE IF NOT EXISTS usage '
-                         '(hash VARCHAR(32), last_read FLOAT)')
-            conn.commit()
-            cur = conn.execute('select * from usage where hash=?', (hash_value,))
-            row = cur.fetchone()
-            if not row:
-                conn.execute("insert into usage(hash, last_read) values(?, ?)", (hash_value, time.time()))
-            else:
-                conn.execute("update usage set last_read=? where hash=?", (time.time(), hash_value))
-            conn.commit()
+        hashs_by_db = {}
+        for hash_value in hash_values:
+            db_name = self._database_from_key(hash_value)
+            if not db_name:
+                db_name = ':memory:'
+            hashs_by_db.setdefault(db_name, []).append(hash_value)
+
+        for db_name, hashs in hashs_by_db.items():
+            with sqlite3.connect(db_name) as conn:
+                """ last_read is a result of time.time()"""
+                conn.execute('CREATE TABLE IF NOT EXISTS usage '
+                             '(hash VARCHAR(32), last_read FLOAT)')
+                conn.commit()
+                for hash_value in hashs:
+                    cur = conn.execute('select * from usage where hash=?', (hash_value,))
+                    row = cur.fetchone()
+                    if not row:
+                        conn.execute("insert into usage(hash, last_read) values(?, ?)", (hash_value, time.time()))
+                    else:
+                        conn.execute("update usage set last_read=? where hash=?", (time.time(), hash_value))
+                conn.commit()
 
     @staticmethod
     def _create_traj_info(row):
@@ -307,16 +377,17 @@ class SqliteDB(AbstractDB):
         value = tuple(str(v) for v in value)
         return repr(value)[1:-2 if len(value) == 1 else -1]
 
-    def _clean(self, n):
+    def _clean(self, n, min_delete=0):
         """
         obtain n% oldest entries by looking into the usage databases. Then these entries
         are deleted first from the traj_info db and afterwards from the associated LRU dbs.
 
         :param n: delete n% entries in traj_info db [and associated LRU (usage) dbs].
+        :param min_delete: delete at least this many entries.
         """
         # delete the n % oldest entries in the database
         import sqlite3
-        num_delete = int(self.num_entries / 100.0 * n)
+        num_delete = max(int(self.num_entries / 100.0 * n), min_delete)
         logger.debug("removing %i entries from db" % num_delete)
         lru_dbs = self._database.execute("select hash, lru_db from traj_info").fetchall()
         lru_dbs.sort(key=itemgetter(1))
@@ -332,33 +403,41 @@ class SqliteDB(AbstractDB):
 
         self.lru_timeout = 1000 #1 sec
 
-        # collect timestamps from databases
-        for db in hashs_by_db.keys():
+        # collect timestamps from all databases, usage entries without a traj_info entry are stale.
+        # Also visit databases without any live entry, so their stale entries get removed as well.
+        known_hashs = set(x[0] for x in lru_dbs)
+        stale = []
+        for db in sorted(set(hashs_by_db.keys()).union(self._usage_databases())):
             with sqlite3.connect(db, timeout=self.lru_timeout) as conn:
                 rows = conn.execute("select hash, last_read from usage").fetchall()
                 for r in rows:
-                    age_by_hash.append((r[0], float(r[1]), db))
+                    if r[0] in known_hashs:
+                        age_by_hash.append((r[0], float(r[1]), db))
+                    else:
+                        stale.append((r[0], None, db))
 
         # sort by age
         age_by_hash.sort(key=itemgetter(1))
         if len(age_by_hash)>=2:
             assert[age_by_hash[-1] > age_by_hash[-2]]
-        ids = map(itemgetter(0), age_by_hash[:num_delete])
-        ids = tuple(map(str, ids))
+        deleted = age_by_hash[:num_delete]
+        ids = tuple(str(x[0]) for x in deleted)
 
         sql_compatible_ids = SqliteDB._format_tuple_for_sql(ids)
 
+        # all oldest entries are removed by a single statement. It is not committed here, so that
+        # callers inside a transaction (bulk_set) commit insertion and clean up at once.
         stmnt = "DELETE FROM traj_info WHERE hash in (%s)" % sql_compatible_ids
         cur = self._database.execute(stmnt)
-        self._database.commit()
         assert cur.rowcount == len(ids), "deleted not as many rows(%s) as desired(%s)" %(cur.rowcount, len(ids))
 
-        # iterate over all LRU databases and delete those ids, we've just deleted from the main db.
-        age_by_hash.sort(key=itemgetter(2))
-        for db, values in itertools.groupby(age_by_hash, key=itemgetter(2)):
-            values = tuple(v[0] for v in values)
+        # iterate over all LRU databases and delete those ids, we've just deleted from the main db,
+        # along with stale ones.
+        obsolete = sorted(deleted + stale, key=itemgetter(2))
+        for db, values in itertools.groupby(obsolete, key=itemgetter(2)):
+            values = tuple(set(v[0] for v in values))
             with sqlite3.connect(db, timeout=self.lru_timeout) as conn:
                     stmnt = "DELETE FROM usage WHERE hash IN (%s)" \
                             % SqliteDB._format_tuple_for_sql(values)
                     curr = conn.execute(stmnt)
-                    assert curr.rowcount == len(values), curr.rowcount
+                    assert curr.rowcount >= len(values), curr.rowcount
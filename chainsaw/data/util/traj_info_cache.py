@@ -23,15 +23,18 @@ Created on 30.04.2015
 from __future__ import absolute_import
 
 import hashlib
+import itertools
 import os
 import sys
 import warnings
+from collections import OrderedDict
 from io import BytesIO
 from logging import getLogger
 
 import numpy as np
 
 from chainsaw import config
+from chainsaw.util.files import prefetch_sequential
 
 logger = getLogger(__name__)
 
@@ -121,7 +124,8 @@ class TrajInfo(object):
 
 class TrajectoryInfoCache(object):
 
-    """ stores trajectory lengths associated to a file based hash (mtime, name, 1mb of data)
+    """ stores trajectory lengths associated to a file based hash (mtime, name, size, first kb of data).
+    The amount of data read to compute the hash is independent of the file size.
 
     Parameters
     ----------
@@ -137,6 +141,15 @@ class TrajectoryInfoCache(object):
     """
     _instance = None
     DB_VERSION = 2
+    # number of file hashes remembered per stat result
+    HASH_CACHE_SIZE = 4096
+    # formats, which have to be scanned entirely to determine their frame offsets
+    SEQUENTIAL_SCAN_EXTENSIONS = ('.xtc', '.trr')
+    # formats, whose cache misses may be computed concurrently in bulk_lookup. Other formats (eg. HDF5 via PyTables)
+    # or user defined readers are not necessarily thread safe.
+    THREAD_SAFE_EXTENSIONS = SEQUENTIAL_SCAN_EXTENSIONS
+    # maximum number of threads used to compute cache misses in bulk_lookup
+    MAX_WORKERS = 8
 
     @staticmethod
     def instance():
@@ -153,11 +166,17 @@ class TrajectoryInfoCache(object):
 
     def __init__(self, database_filename=None):
         self.database_filename = database_filename
+        self._hash_cache = OrderedDict()
 
-        # have no filename, use in memory sqlite db
+        # have no filename, use dict, since there is nothing to persist
         # have no sqlite module, use dict
         # have sqlite and file, create db with given filename
 
+        if self.database_filename is None:
+            from chainsaw.data.util.traj_info_backends import DictDB
+            self._database = DictDB()
+            return
+
         try:
             import sqlite3
             from chainsaw.data.util.traj_info_backends import SqliteDB
@@ -184,10 +203,9 @@ class TrajectoryInfoCache(object):
         with open(filename, PyCSVReader.DEFAULT_OPEN_MODE) as fh:
             reader._determine_dialect(fh, length)
 
-    def __getitem__(self, filename_reader_tuple):
-        filename, reader = filename_reader_tuple
+    def _get_cached(self, filename, reader, key):
+        # returns the stored TrajInfo for the given key or None in case of a cache miss.
         abs_path = os.path.abspath(filename)
-        key = self.hash_file(filename)
         try:
             info = self._database.get(key)
             if not isinstance(info, TrajInfo):
@@ -200,9 +218,23 @@ class TrajectoryInfoCache(object):
         # handle cache misses and not interpretable results by re-computation.
         # Note: this also handles UnknownDBFormatExceptions!
         except KeyError:
-            info = reader._get_traj_info(filename)
-            info.hash_value = key
-            info.abs_path = abs_path
+            return None
+        return info
+
+    def _compute(self, filename, reader, key):
+        if os.path.splitext(filename)[1] in self.SEQUENTIAL_SCAN_EXTENSIONS:
+            prefetch_sequential(filename)
+        info = reader._get_traj_info(filename)
+        info.hash_value = key
+        info.abs_path = os.path.abspath(filename)
+        return info
+
+    def __getitem__(self, filename_reader_tuple):
+        filename, reader = filename_reader_tuple
+        key = self.hash_file(filename)
+        info = self._get_cached(filename, reader, key)
+        if info is None:
+            info = self._compute(filename, reader, key)
             # store info in db
             self.__setitem__(info)
 
@@ -212,6 +244,72 @@ class TrajectoryInfoCache(object):
 
         return info
 
+    def bulk_lookup(self, filenames, reader, callback=None):
+        """ obtain the TrajInfo objects for several files of the same reader.
+
+        In contrast to looking up every file on its own, the cache misses of formats
+        listed in THREAD_SAFE_EXTENSIONS are computed concurrently in a thread pool,
+        so the I/O of several files can overlap. All other misses are computed in
+        this thread. Afterwards they are stored at once, so the database only has to
+        commit a single transaction.
+
+        Parameters
+        ----------
+        filenames : list of str
+        reader : DataSource
+            the reader used to compute the info in case of a cache miss.
+        callback : callable (optional)
+            invoked without arguments after each processed file, eg. to report progress.
+
+        Returns
+        -------
+        infos : list of TrajInfo
+            infos in the same order as the given file names.
+        """
+        infos = [None] * len(filenames)
+        missing = []
+        # the database connection may only be used by this thread, so lookups happen here.
+        for i, filename in enumerate(filenames):
+            key = self.hash_file(filename)
+            info = self._get_cached(filename, reader, key)
+            if info is None:
+                missing.append((i, filename, key))
+            else:
+                infos[i] = info
+                if callback is not None:
+                    callback()
+
+        if not missing:
+            return infos
+
+        def compute(args):
+            i, filename, key = args
+            return i, self._compute(filename, reader, key)
+
+        concurrent = [m for m in missing if os.path.splitext(m[1])[1] in self.THREAD_SAFE_EXTENSIONS]
+        serial = [m for m in missing if os.path.splitext(m[1])[1] not in self.THREAD_SAFE_EXTENSIONS]
+        if len(concurrent) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.MAX_WORKERS, len(concurrent)))
+            results = itertools.chain(pool.imap(compute, concurrent), (compute(m) for m in serial))
+        else:
+            pool = None
+            results = (compute(m) for m in missing)
+        try:
+            for i, info in results:
+                infos[i] = info
+                if callback is not None:
+                    callback()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        self._database.bulk_set([infos[i] for i, _, _ in missing])
+        if hasattr(self._database, 'sync'):
+            self._database.sync()
+
+        return infos
+
     def _get_file_hash(self, filename):
         statinfo = os.stat(filename)
 
@@ -221,17 +319,19 @@ class TrajectoryInfoCache(object):
         hash_value ^= hash(statinfo.st_mtime)
         hash_value ^= hash(statinfo.st_size)
 
-        # now read the first megabyte and hash it
+        # now read the first kilobyte and hash it
         with open(filename, mode='rb') as fh:
             data = fh.read(1024)
 
         hash_value ^= hash(data)
         return str(hash_value)
 
-    def _get_file_hash_v2(self, filename):
-        statinfo = os.stat(filename)
-        # now read the first megabyte and hash it
+    def _get_file_hash_v2(self, filename, statinfo=None):
+        # if no stat result is given, stat the already opened handle, so the path is only resolved once.
         with open(filename, mode='rb') as fh:
+            if statinfo is None:
+                statinfo = os.fstat(fh.fileno())
+            # now read the first kilobyte and hash it
             data = fh.read(1024)
 
         hasher = hashlib.md5()
@@ -242,7 +342,20 @@ class TrajectoryInfoCache(object):
         return hasher.hexdigest()
 
     def hash_file(self, filename):
-        return self._get_file_hash_v2(filename)
+        # the hash can only change, if the file has been modified. So it is remembered for the
+        # path, modification time and size of the file and only recomputed, if one of those changed.
+        statinfo = os.stat(filename)
+        stat_key = (os.path.abspath(filename),
+                    getattr(statinfo, 'st_mtime_ns', statinfo.st_mtime), statinfo.st_size)
+        try:
+            hash_value = self._hash_cache.pop(stat_key)
+        except KeyError:
+            hash_value = self._get_file_hash_v2(filename, statinfo)
+            if len(self._hash_cache) >= self.HASH_CACHE_SIZE:
+                self._hash_cache.popitem(last=False)
+        # (re-)insert as most recently used
+        self._hash_cache[stat_key] = hash_value
+        return hash_value
 
     def __setitem__(self, traj_info):
         self._database.set(traj_info)
@@ -22,7 +22,11 @@ Created on 30.04.2015
 
 from __future__ import absolute_import
 
+import glob
+import itertools
 import os
+import shutil
+import sqlite3
 import tempfile
 import unittest
 from tempfile import NamedTemporaryFile
@@ -37,7 +41,7 @@ from chainsaw import config
 from chainsaw.data.md.feature_reader import FeatureReader
 from chainsaw.data.numpy_filereader import NumPyFileReader
 from chainsaw.data.py_csv_reader import PyCSVReader
-from chainsaw.data.util.traj_info_backends import SqliteDB
+from chainsaw.data.util.traj_info_backends import SqliteDB, DictDB
 from chainsaw.data.util.traj_info_cache import TrajectoryInfoCache
 from chainsaw.tests.util import create_traj, get_bpti_test_data
 from chainsaw.util.contexts import settings
@@ -51,24 +55,45 @@ class TestTrajectoryInfoCache(unittest.TestCase):
     def setUpClass(cls):
         cls.old_instance = TrajectoryInfoCache.instance()
         config.use_trajectory_lengths_cache = True
+        # the database is shared by all tests and only truncated in between.
+        # prefer a RAM backed file system, if available
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+        cls.work_dir = tempfile.mkdtemp("traj_cache_test", dir=shm)
+        cls.tmpfile = tempfile.mktemp(dir=cls.work_dir)
+        cls._open_db()
+
+    @classmethod
+    def _open_db(cls):
+        cls.db = TrajectoryInfoCache(cls.tmpfile)
+        # keep the backend, tests may replace it on cls.db
+        cls.sqlite_db = cls.db._database
 
     def setUp(self):
-        self.work_dir = tempfile.mkdtemp("traj_cache_test")
-        self.tmpfile = tempfile.mktemp(dir=self.work_dir)
-        self.db = TrajectoryInfoCache(self.tmpfile)
+        # tests may close or replace the shared database, re-open it in that case.
+        try:
+            self.sqlite_db._database.execute("SELECT 1")
+            is_open = self.db._database is self.sqlite_db
+        except sqlite3.ProgrammingError:
+            is_open = False
+        if not is_open:
+            self.db.close()
+            self.sqlite_db.close()
+            type(self)._open_db()
+        conn = self.db._database._database
+        conn.execute("DELETE FROM traj_info")
+        conn.execute("VACUUM")
+        self.db._hash_cache.clear()
+        shutil.rmtree(os.path.join(self.work_dir, 'traj_info_usage'), ignore_errors=True)
 
         # overwrite TrajectoryInfoCache._instance with self.db...
         TrajectoryInfoCache._instance = self.db
 
-    def tearDown(self):
-        self.db.close()
-        os.unlink(self.tmpfile)
-
-        import shutil
-        shutil.rmtree(self.work_dir, ignore_errors=True)
-
     @classmethod
     def tearDownClass(cls):
+        cls.db.close()
+        cls.sqlite_db.close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
         TrajectoryInfoCache._instance = cls.old_instance
         config.use_trajectory_lengths_cache = False
 
@@ -83,7 +108,7 @@ class TestTrajectoryInfoCache(unittest.TestCase):
         my_conf = config()
         my_conf.cfg_dir = self.work_dir
         with mock.patch('chainsaw.data.util.traj_info_cache.config', my_conf):
-            with NamedTemporaryFile(delete=False) as fh:
+            with NamedTemporaryFile(delete=False, dir=self.work_dir) as fh:
                 np.savetxt(fh.name, x)
                 reader = api.source(fh.name)
                 info = self.db[fh.name, reader]
@@ -92,6 +117,50 @@ class TestTrajectoryInfoCache(unittest.TestCase):
                 info2 = self.db[fh.name, reader]
                 self.assertEqual(info2, info)
 
+    def test_hash_file_cached(self):
+        fn = os.path.join(self.work_dir, 'data.npy')
+        np.save(fn, np.arange(10))
+        with mock.patch.object(self.db, '_get_file_hash_v2', wraps=self.db._get_file_hash_v2) as m:
+            h1 = self.db.hash_file(fn)
+            h2 = self.db.hash_file(fn)
+            self.assertEqual(h1, h2)
+            self.assertEqual(m.call_count, 1)
+
+            # modification of the file invalidates the remembered hash
+            np.save(fn, np.arange(20))
+            h3 = self.db.hash_file(fn)
+            self.assertEqual(m.call_count, 2)
+            self.assertNotEqual(h1, h3)
+
+        # on a miss the stat result of hash_file is reused instead of stat-ing the file again.
+        self.db._hash_cache.clear()
+        with mock.patch('os.fstat', wraps=os.fstat) as fstat:
+            h4 = self.db.hash_file(fn)
+            fstat.assert_not_called()
+        self.assertEqual(h4, h3)
+        self.assertEqual(h4, self.db._get_file_hash_v2(fn))
+
+    def test_journal_mode(self):
+        fn = os.path.join(self.work_dir, 'journal.sqlite3')
+        # switching back from WAL has to work, since the journal mode is stored in the file.
+        for use_wal, mode in ((True, 'wal'), (False, 'delete')):
+            with settings(traj_info_use_wal=use_wal):
+                db = SqliteDB(fn)
+                try:
+                    self.assertEqual(db._database.execute("PRAGMA journal_mode").fetchone()[0], mode)
+                finally:
+                    db.close()
+
+    def test_duplicate_hash(self):
+        fn = os.path.join(self.work_dir, 'data.npy')
+        np.save(fn, np.arange(10))
+        reader = NumPyFileReader(fn)
+        info = self.db[fn, reader]
+        self.db._database.set(info)
+        self.db._database.bulk_set([info, info])
+        self.assertEqual(self.db.num_entries, 1)
+        self.assertEqual(self.db[fn, reader], info)
+
     def test_exceptions(self):
         # in accessible files
         not_existant = ''.join(
@@ -113,41 +182,85 @@ class TestTrajectoryInfoCache(unittest.TestCase):
         with settings(use_trajectory_lengths_cache=False):
             reader = FeatureReader(xtcfiles, pdbfile)
 
-        results = {}
-        for f in xtcfiles:
-            traj_info = self.db[f, reader]
-            results[f] = traj_info.ndim, traj_info.length, traj_info.offsets
+        dtype = [('ndim', 'i4'), ('length', 'i8'), ('offsets', 'O')]
+        results = np.array([(traj_info.ndim, traj_info.length, traj_info.offsets)
+                            for traj_info in self.db.bulk_lookup(xtcfiles, reader)], dtype=dtype)
 
-        expected = {}
+        expected = []
         for f in xtcfiles:
             with mdtraj.open(f) as fh:
                 length = len(fh)
                 ndim = fh.read(1)[0].shape[1]
                 offsets = fh.offsets if hasattr(fh, 'offsets') else []
-                expected[f] = ndim, length, offsets
-
-        np.testing.assert_equal(results, expected)
+                expected.append((ndim, length, offsets))
+        expected = np.array(expected, dtype=dtype)
+
+        np.testing.assert_array_equal(results['ndim'], expected['ndim'])
+        np.testing.assert_array_equal(results['length'], expected['length'])
+        for res_offsets, exp_offsets in zip(results['offsets'], expected['offsets']):
+            np.testing.assert_array_equal(res_offsets, exp_offsets)
+
+    def test_bulk_lookup_order(self):
+        lengths = np.arange(10, 22)
+        # serially computed misses and misses computed in the thread pool
+        for safe_extensions in ((), ('.npy', )):
+            files = []
+            for i, n in enumerate(lengths):
+                fn = os.path.join(self.work_dir, "bulk_%s_%i.npy" % (len(safe_extensions), i))
+                np.save(fn, np.zeros((n, 2)))
+                files.append(fn)
+            with settings(use_trajectory_lengths_cache=False):
+                reader = NumPyFileReader(files)
+            n_entries = self.db.num_entries
+            # cause hits for every third file
+            for f in files[::3]:
+                self.db[f, reader]
+            from multiprocessing.pool import ThreadPool
+            # large enough, so that no entry gets evicted
+            with mock.patch.object(TrajectoryInfoCache, 'THREAD_SAFE_EXTENSIONS', safe_extensions), \
+                    mock.patch('multiprocessing.pool.ThreadPool', wraps=ThreadPool) as pool, \
+                    settings(traj_info_max_entries=100):
+                infos = self.db.bulk_lookup(files, reader)
+            self.assertEqual(pool.called, bool(safe_extensions))
+            np.testing.assert_equal([info.length for info in infos], lengths)
+            np.testing.assert_equal([info.abs_path for info in infos], [os.path.abspath(f) for f in files])
+            self.assertEqual(self.db.num_entries, n_entries + len(files))
 
     def test_npy_reader(self):
-        lengths_and_dims = [(7, 3), (23, 3), (27, 3)]
-        data = [
-            np.empty((n, dim)) for n, dim in lengths_and_dims]
+        lengths = [7, 23, 27]
+        # slice all arrays from one preallocated buffer
+        buf = np.empty((sum(lengths), 3))
+        data = np.split(buf, np.cumsum(lengths)[:-1])
         files = []
         with TemporaryDirectory() as td:
             for i, x in enumerate(data):
                 fn = os.path.join(td, "%i.npy" % i)
-                np.save(fn, x)
+                with open(fn, 'wb') as fh:
+                    np.lib.format.write_array(fh, x, allow_pickle=False)
                 files.append(fn)
 
             reader = NumPyFileReader(files)
 
             # cache it and compare
-            results = {f: (self.db[f, reader].length, self.db[f, reader].ndim,
-                           self.db[f, reader].offsets) for f in files}
+            results = {}
+            for f in files:
+                traj_info = self.db[f, reader]
+                results[f] = traj_info.length, traj_info.ndim, traj_info.offsets
             expected = {f: (len(data[i]), data[i].shape[1], [])
                         for i, f in enumerate(files)}
             np.testing.assert_equal(results, expected)
 
+    @staticmethod
+    def _readline_offsets(fn):
+        # reference implementation: byte offsets of all lines, empty lines filtered.
+        offsets = [0]
+        with open(fn, 'rb') as new_fh:
+            while new_fh.readline():
+                offsets.append(new_fh.tell())
+        offsets = np.array(offsets)
+        mask = np.insert(np.diff(offsets) > 2, 0, True)
+        return offsets[mask]
+
     def test_csvreader(self):
         data = np.random.random((101, 3))
         fn = tempfile.mktemp()
@@ -165,6 +278,25 @@ class TestTrajectoryInfoCache(unittest.TestCase):
         finally:
             os.unlink(fn)
 
+    def test_csv_calc_offsets(self):
+        contents = {'no_trailing_newline': b'1 2 3\n4 5 6\n7 8 9',
+                    'crlf': b'1 2 3\r\n4 5 6\r\n7 8 9\r\n',
+                    'blank_lines': b'1 2 3\n\n4 5 6\n\r\n\n7 8 9\n',
+                    'empty': b'',
+                    }
+        expected_lengths = {'no_trailing_newline': 3, 'crlf': 3, 'blank_lines': 3, 'empty': 0}
+        # a small window makes line breaks fall onto window boundaries.
+        for window in (PyCSVReader.OFFSETS_SCAN_WINDOW, 1, 4, 7):
+            with mock.patch.object(PyCSVReader, 'OFFSETS_SCAN_WINDOW', window):
+                for name, content in contents.items():
+                    fn = os.path.join(self.work_dir, name + '.dat')
+                    with open(fn, 'wb') as fh:
+                        fh.write(content)
+                    with open(fn, PyCSVReader.DEFAULT_OPEN_MODE) as fh:
+                        length, offsets = PyCSVReader._calc_offsets(fh)
+                    np.testing.assert_equal(offsets, self._readline_offsets(fn), err_msg=name)
+                    self.assertEqual(length, expected_lengths[name], msg=name)
+
     def test_fragmented_reader(self):
         top_file = pkg_resources.resource_filename(__name__, 'data/test.pdb')
         trajfiles = []
@@ -176,10 +308,11 @@ class TestTrajectoryInfoCache(unittest.TestCase):
                 nframes.append(l)
             # three trajectories: one consisting of all three, one consisting of the first,
             # one consisting of the first and the last
+            nframes = np.array(nframes)
             reader = api.source(
                 [trajfiles, [trajfiles[0]], [trajfiles[0], trajfiles[2]]], top=top_file)
-            np.testing.assert_equal(reader.trajectory_lengths(),
-                                    [sum(nframes), nframes[0], nframes[0] + nframes[2]])
+            np.testing.assert_array_equal(reader.trajectory_lengths(),
+                                          np.array([nframes.sum(), nframes[0], nframes[[0, 2]].sum()]))
 
     def test_feature_reader_xyz(self):
         traj = mdtraj.load(xtcfiles, top=pdbfile)
@@ -240,22 +373,84 @@ class TestTrajectoryInfoCache(unittest.TestCase):
         self.assertEqual(self.db.num_entries, len(xtcfiles))
 
     def test_max_n_entries(self):
-        data = [np.random.random((10, 3)) for _ in range(20)]
+        data = np.random.random((20, 10, 3))
         max_entries = 10
-        config.traj_info_max_entries = max_entries
         files = []
-        with TemporaryDirectory() as td:
+        with TemporaryDirectory() as td, settings(traj_info_max_entries=max_entries):
             for i, arr in enumerate(data):
                 f = os.path.join(td, "%s.npy" % i)
-                np.save(f, arr)
+                with open(f, 'wb') as fh:
+                    np.lib.format.write_array(fh, arr, allow_pickle=False)
                 files.append(f)
             chainsaw.source(files)
         self.assertLessEqual(self.db.num_entries, max_entries)
         self.assertGreater(self.db.num_entries, 0)
 
+    def test_lru_eviction(self):
+        from chainsaw.data.util import traj_info_backends
+        usage_dir = os.path.join(self.work_dir, 'traj_info_usage')
+
+        def usage():
+            # hash -> last_read of all usage databases
+            result = {}
+            for db in glob.glob(os.path.join(usage_dir, '*.db')):
+                conn = sqlite3.connect(db)
+                try:
+                    result.update(conn.execute("select hash, last_read from usage").fetchall())
+                finally:
+                    conn.close()
+            return result
+
+        def create(prefix, n):
+            files = []
+            for i in range(n):
+                fn = os.path.join(self.work_dir, "%s_%i.npy" % (prefix, i))
+                np.save(fn, np.zeros((i + 1, 2)))
+                files.append(fn)
+            return files
+
+        def stored_hashes():
+            return set(row[0] for row in self.db._database._database.execute("select hash from traj_info"))
+
+        first, second = create('first', 10), create('second', 6)
+        with settings(use_trajectory_lengths_cache=False):
+            reader = NumPyFileReader(first + second)
+        hashes = {f: self.db.hash_file(f) for f in first + second}
+
+        # strictly increasing time stamps, so the eviction order is well defined.
+        clock = mock.Mock()
+        clock.time.side_effect = itertools.count(1)
+        with mock.patch.object(traj_info_backends, 'time', clock), settings(traj_info_max_entries=10):
+            # reaching 10 entries evicts the 30 % oldest ones
+            for f in first:
+                self.db[f, reader]
+            survivors = set(hashes[f] for f in first[3:])
+            self.assertEqual(stored_hashes(), survivors)
+            # survivors keep their usage entries, evicted ones lose them
+            self.assertEqual(set(usage().keys()), survivors)
+
+            # usage entries without a traj_info entry are ignored and removed during the next eviction,
+            # both next to a surviving entry and in a database without any live entry.
+            stale_dbs = (self.db._database._database_from_key(hashes[first[9]]),
+                         os.path.join(usage_dir, 'stale.db'))
+            for stale_hash, stale_db in zip(('0' * 32, '1' * 32), stale_dbs):
+                with sqlite3.connect(stale_db) as conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS usage (hash VARCHAR(32), last_read FLOAT)')
+                    conn.execute("insert into usage(hash, last_read) values(?, ?)", (stale_hash, 0))
+
+            # two more evictions, each removes the three oldest entries
+            for f in second:
+                self.db[f, reader]
+            expected = set(hashes[f] for f in first[9:] + second)
+            self.assertEqual(stored_hashes(), expected)
+            self.assertEqual(set(usage().keys()), expected)
+            self.assertEqual(self.db.num_entries, 7)
+
     def test_max_size(self):
-        data = [np.random.random((150, 10)) for _ in range(150)]
+        data = np.random.random((150, 150, 10))
         max_size = 1
+        # format string for a whole file, so every file is rendered by a single formatting operation
+        file_fmt = (' '.join(['%.18e'] * data.shape[2]) + '\n') * data.shape[1]
 
         files = []
         config.show_progress_bars = False
@@ -263,7 +458,8 @@ class TestTrajectoryInfoCache(unittest.TestCase):
             for i, arr in enumerate(data):
                 f = os.path.join(td, "%s.txt" % i)
                 # save as txt to enforce creation of offsets
-                np.savetxt(f, arr)
+                with open(f, 'w') as fh:
+                    fh.write(file_fmt % tuple(arr.ravel()))
                 files.append(f)
             chainsaw.source(files)
 
@@ -272,35 +468,23 @@ class TestTrajectoryInfoCache(unittest.TestCase):
 
     def test_no_working_directory(self):
         # this is the case as long as the user has not yet created a config directory via config.save()
-        self.db._database = SqliteDB(filename=None)
+        self.db._database = TrajectoryInfoCache(None)._database
+        self.assertIsInstance(self.db._database, DictDB)
 
         # trigger caching
         chainsaw.source(xtcfiles, top=pdbfile)
 
     def test_no_sqlite(self):
-        # create new instance (init has to be called, install temporary import hook to raise importerror for sqlite3
+        # create new instance (init has to be called), a None entry in sys.modules raises ImportError for sqlite3
         import sys
-        del sys.modules['sqlite3']
-
-        class meta_ldr(object):
-            def find_module(self, fullname, path):
-                if fullname.startswith('sqlite3'):
-                    return self
-
-            def load_module(self, fullname, path=None):
-                raise ImportError()
-
         import warnings
-        try:
-            sys.meta_path.insert(0, meta_ldr())
-            # import sqlite3
+        with mock.patch.dict(sys.modules, {'sqlite3': None}):
             with warnings.catch_warnings(record=True) as cw:
-                db = TrajectoryInfoCache()
+                warnings.simplefilter('always')
+                db = TrajectoryInfoCache(os.path.join(self.work_dir, 'no_sqlite.db'))
                 self.assertNotIsInstance(db._database, SqliteDB)
-            self.assertEqual(len(cw), 1)
-            self.assertIn("sqlite3 package not available", cw[0].message.args[0])
-        finally:
-            del sys.meta_path[0]
+        self.assertEqual(len(cw), 1)
+        self.assertIn("sqlite3 package not available", cw[0].message.args[0])
 
     def test_in_memory_db(self):
         """ new instance, not yet saved to disk, no lru cache avail """
@@ -311,10 +495,9 @@ class TestTrajectoryInfoCache(unittest.TestCase):
             reader = chainsaw.source(xtcfiles, top=pdbfile)
 
             info = db[xtcfiles[0], reader]
-            self.assertIsInstance(db._database, SqliteDB)
-
-            directory = db._database._database_from_key(info.hash_value)
-            assert directory is None
+            self.assertIsInstance(db._database, DictDB)
+            self.assertEqual(db.num_entries, 1)
+            self.assertIs(db[xtcfiles[0], reader], info)
         finally:
             from chainsaw.util.exceptions import ConfigDirectoryException
             try:
@@ -32,7 +32,7 @@ import pkg_resources
 
 # for IDE stupidity, just add a new cfg var here, if you add a property to Wrapper
 cache_dir = cfg_dir = default_config_file = default_logging_config = logging_config = \
-    show_progress_bars = used_filenames = use_trajectory_lengths_cache = None
+    show_progress_bars = used_filenames = use_trajectory_lengths_cache = traj_info_use_wal = None
 
 __all__ = ('cache_dir',
            'cfg_dir',
@@ -44,6 +44,7 @@ __all__ = ('cache_dir',
            'use_trajectory_lengths_cache',
            'traj_info_max_entries',
            'traj_info_max_size',
+           'traj_info_use_wal',
            )
 
 if six.PY2:
@@ -143,6 +144,10 @@ In order to load a pre-saved configuration file, use the :py:func:`load` method:
 >>> config.load('chainsaw_silent.cfg') # doctest: +SKIP
 
     """
+    # settings are properties backed by _conf_values. Besides storing the remaining state without an instance
+    # dictionary, this turns assignments to unknown (eg. misspelled) settings into an AttributeError.
+    __slots__ = ('_conf_values', '_cfg_dir', '_used_filenames', 'wrapped', '__wrapped__')
+
     DEFAULT_CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.chainsaw')
     DEFAULT_CONFIG_FILE_NAME = 'chainsaw.cfg'
     DEFAULT_LOGGING_FILE_NAME = 'logging.yml'
@@ -368,6 +373,15 @@ In order to load a pre-saved configuration file, use the :py:func:`load` method:
         val = str(int(val))
         self._conf_values.set('chainsaw', 'traj_info_max_size', val)
 
+    @property
+    def traj_info_use_wal(self):
+        """ use write ahead logging for the trajectory info database. Does not work on network file systems. """
+        return self._conf_values.getboolean('chainsaw', 'traj_info_use_wal')
+
+    @traj_info_use_wal.setter
+    def traj_info_use_wal(self, val):
+        self._conf_values.set('chainsaw', 'traj_info_use_wal', str(val))
+
     @property
     def show_progress_bars(self):
         return self._conf_values.getboolean('chainsaw', 'show_progress_bars')
@@ -40,6 +40,26 @@ def mkdir_p(path):
             raise
 
 
+def prefetch_sequential(path):
+    """ hints the operating system, that the given file will be read sequentially
+    and soon, so it can read ahead in larger blocks. This is a no-op on platforms
+    not supporting posix_fadvise.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 class TemporaryDirectory(object):
     """Create and return a temporary directory.  This has the same
     behavior as mkdtemp but can be used as a context manager.  For